@@ -0,0 +1,155 @@
+""" asyncio counterpart of `programmer`.
+
+`AsyncProgrammer` talks to the bootloader over a pair of asyncio streams, so
+a single event loop can drive any number of boards. `AsyncProgrammer.flash`
+is an async iterator of `Progress` events; cancelling the task iterating it
+stops the run between frames, with the journal left at the last verified
+erase block.
+
+What to send and how to check it is all in `programmer.Protocol`, shared
+with the blocking programmer; this module only carries out its steps.
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from .programmer import MAX_RETURN, Protocol, Send, Receive, Call, Timeout, Event, decode_reply, map_image
+from .journal import journal_path
+from .sfdp import CACHE_PATH
+
+@dataclass
+class Progress:
+    # phase, sector and done are those of the programmer.Event it reports
+    # (message too, for "resume", "restart" and "mismatch"); rate is in
+    # bytes per second, counting only what this run has written.
+    phase: str
+    sector: int
+    done: int
+    total: int
+    rate: float
+    message: Optional[str] = None
+
+class AsyncProgrammer:
+    # Carries out programmer.Protocol steps on asyncio streams.
+    def __init__(self, reader, writer, depth=16, timeout=2, name=None):
+        self.reader  = reader
+        self.writer  = writer
+        self.timeout = timeout
+        # Port name, which keeps each board's journal apart.
+        self.name    = name
+        self.proto   = Protocol(depth)
+        # Replies still owed by the device, e.g. after a cancelled batch.
+        self.outstanding = 0
+
+    @classmethod
+    async def open(cls, port="/dev/ttyACM0", **kwargs):
+        import serial_asyncio
+        reader, writer = await serial_asyncio.open_serial_connection(url=port)
+        return cls(reader, writer, name=port, **kwargs)
+
+    @property
+    def info(self):
+        return self.proto.info
+
+    async def close(self):
+        self.writer.close()
+        if hasattr(self.writer, "wait_closed"):
+            await self.writer.wait_closed()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def _step(self, step):
+        if type(step) is Send:
+            # The transport may hold on to what it can't send right away, and
+            # the encoder reuses its buffer for the next batch.
+            self.writer.write(bytes(step.frames))
+            self.outstanding += step.count
+            await self.writer.drain()
+        elif type(step) is Receive:
+            dst = 0
+            for size in step.sizes:
+                line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+                self.outstanding -= 1
+                decode_reply(line, size, step.out[dst:dst + size])
+                dst += size
+            return step.out[:dst]
+        elif type(step) is Call:
+            return await asyncio.get_running_loop().run_in_executor(None, step.fn, *step.args)
+        elif type(step) is Timeout:
+            self.timeout = max(self.timeout, step.seconds)
+
+    async def drive(self, steps):
+        # Run steps to completion, ignoring events, and return their result.
+        reply = None
+        try:
+            while True:
+                step = steps.send(reply)
+                reply = None if type(step) is Event else await self._step(step)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            steps.close()
+
+    async def sync(self):
+        # Collect anything owed from an interrupted run, then reset the
+        # reply start character as programmer.Link.sync does.
+        while self.outstanding:
+            await asyncio.wait_for(self.reader.readline(), self.timeout)
+            self.outstanding -= 1
+        await self.run(0, b"\x04")
+
+    async def run(self, out_bytes, header, payload=b""):
+        return await self.drive(self.proto.run(out_bytes, header, payload))
+
+    async def probe(self, cache_path=CACHE_PATH):
+        return await self.drive(self.proto.probe(cache_path))
+
+    async def read(self, addr, out, chunk=MAX_RETURN, progress=None):
+        return await self.drive(self.proto.read(addr, out, chunk, progress))
+
+    async def flash(self, path="build/top.bit", base_addr=0x200_000, journal=True,
+                    cache_path=CACHE_PATH):
+        """ Program the image at path, yielding Progress events as it goes;
+        the arguments are those of programmer.flash.
+        """
+        began = time.monotonic()
+        # Offset this run started from, so a resumed run's rate only counts
+        # what it wrote itself.
+        resumed = 0
+        with open(path, "rb") as f:
+            image = map_image(f)
+            await self.sync()
+            steps = self.proto.flash(image, base_addr, journal_path(path, self.name) if journal else None, cache_path)
+            reply = None
+            try:
+                while True:
+                    step = steps.send(reply)
+                    if type(step) is not Event:
+                        reply = await self._step(step)
+                        continue
+                    reply = None
+                    if step.phase == "resume":
+                        resumed = step.done
+                    elapsed = time.monotonic() - began
+                    rate = (step.done - resumed) / elapsed if elapsed and step.done > resumed else 0.0
+                    yield Progress(step.phase, step.sector, step.done, len(image), rate, step.message)
+            except StopIteration:
+                pass
+            finally:
+                steps.close()
+
+async def flash_all(ports, path="build/top.bit", callback=print, **kwargs):
+    """ Flash the same image to several boards concurrently, passing
+    (port, Progress) to callback for every event.
+    """
+    async def one(port):
+        async with await AsyncProgrammer.open(port) as prog:
+            async for event in prog.flash(path, **kwargs):
+                callback(port, event)
+    await asyncio.gather(*(one(port) for port in ports))
@@ -0,0 +1,148 @@
+import io
+import os
+from timeit import timeit
+from itertools import count
+from itertools import islice
+from .programmer import Encoder, Decoder, decode_reply
+
+MIB = 1 << 20
+
+# The programmer's original frame helpers, kept as the baseline.
+
+def complement(a):
+    return (0x100 - (a & 0xff)) & 0xff
+
+def command(out_bytes, command):
+    command_bytes = bytes(command)
+    in_bytes = len(command)
+    return f".{in_bytes:02x}{out_bytes:02x}{command.hex()}{complement(in_bytes + out_bytes + sum(command_bytes)):02x}\r\n".encode("utf8")
+
+def chunk_iterable(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = bytes(islice(it, size))
+        if not chunk:
+            break
+        yield chunk
+
+def chunk_file(f, chunk_size):
+    for chunk in iter(lambda: f.read(chunk_size), b""):
+        yield chunk
+
+def _per_mib(label, fn, pages, page_size, repeat=3):
+    # Report the best of a few runs, scaled to one MiB of page data.
+    best = min(timeit(fn, number=1) for _ in range(repeat))
+    scale = MIB / (pages * page_size)
+    print(f"{label:<28} {best * scale * 1e3:8.2f} ms/MiB")
+
+def codec(size=MIB, page_size=128, batch=16):
+    """ Time frame encoding and reply decoding for a page-programming pass
+    over `size` bytes of random data, with the old per-page helpers as a
+    baseline.
+    """
+    image = memoryview(os.urandom(size))
+    pages = size // page_size
+    addrs = [(i * page_size).to_bytes(3, "big") for i in range(pages)]
+
+    def encode_legacy():
+        f = io.BytesIO(image)
+        for b_addr, chunk in zip(count(0, 0x1000), chunk_file(f, 0x1000)):
+            for addr, page in zip(count(b_addr, page_size), chunk_iterable(chunk, page_size)):
+                command(0, b"\x02" + addr.to_bytes(3, "big") + page)
+
+    enc = Encoder()
+    def encode():
+        for i, a in enumerate(addrs):
+            enc.encode(0, b"\x02" + a, image[i * page_size:(i + 1) * page_size])
+
+    # One readback reply per page, as the device would send it.
+    replies = b"".join(
+        b"." + image[i * page_size:(i + 1) * page_size].hex().upper().encode("ascii") + b"\n"
+        for i in range(pages)
+    )
+
+    class Port(io.BytesIO):
+        def flush(self):
+            pass
+
+    def decode_legacy():
+        port = Port(replies)
+        for i in range(pages):
+            readback = port.readline()
+            expected = f".{image[i * page_size:(i + 1) * page_size].hex()}\n".upper().encode("utf8")
+            expected.startswith(readback.strip())
+
+    dec = Decoder()
+    def decode():
+        port = Port(replies)
+        for i in range(pages):
+            decode_reply(port.readline(), page_size, dec.view) == image[i * page_size:(i + 1) * page_size]
+
+    # A whole page write as flash() does it: write enable, program and
+    # read back, then compare. The old programmer sent and awaited each
+    # frame in turn; Link.write_page sends all three and reads the replies
+    # in one go.
+    triples = b"".join(b".\n.\n." + reply[1:] for reply in replies.splitlines(keepends=True))
+    def page_write_legacy():
+        port = Port(triples)
+        for i in range(pages):
+            page = bytes(image[i * page_size:(i + 1) * page_size])
+            addr = (i * page_size).to_bytes(3, "big")
+            command(0, b"\x06")
+            port.readline()
+            command(0, b"\x02" + addr + page)
+            port.readline()
+            command(page_size, b"\x03" + addr)
+            readback = port.readline()
+            f".{page.hex()}\n".upper().encode("utf8").startswith(readback.strip())
+
+    page_enc = Encoder(3)
+    def page_write():
+        port = Port(triples)
+        for i, a in enumerate(addrs):
+            page = image[i * page_size:(i + 1) * page_size]
+            page_enc.clear()
+            page_enc.add(0, b"\x06")
+            page_enc.add(0, b"\x02" + a, page)
+            page_enc.add(page_size, b"\x03" + a)
+            bytes(dec.read(port, (0, 0, page_size))) != bytes(page)
+
+    out = bytearray(size)
+    def decode_batched():
+        port = Port(replies)
+        view = memoryview(out)
+        for i in range(0, pages, batch):
+            n = min(batch, pages - i)
+            dec.read(port, (page_size,) * n, view[i * page_size:(i + n) * page_size])
+
+    print(f"{size // 1024} KiB in {page_size} byte pages")
+    _per_mib("encode (f-string)", encode_legacy, pages, page_size)
+    _per_mib("encode (Encoder)", encode, pages, page_size)
+    _per_mib("decode+verify (readline)", decode_legacy, pages, page_size)
+    _per_mib("decode+verify (decode_reply)", decode, pages, page_size)
+    _per_mib("page write (f-string, x3)", page_write_legacy, pages, page_size)
+    _per_mib("page write (Encoder+Decoder)", page_write, pages, page_size)
+    _per_mib(f"decode (Decoder, x{batch})", decode_batched, pages, page_size)
+
+def emulated_flash(size=256 * 1024, **kwargs):
+    """ Run programmer.flash against the emulator and report both the host
+    CPU time and the time the transfer would take on a board.
+    """
+    import tempfile
+    from time import process_time
+    from .emulator import EmulatedSerial
+    from . import programmer
+
+    with tempfile.NamedTemporaryFile(suffix=".bit") as f:
+        f.write(os.urandom(size))
+        f.flush()
+        port = EmulatedSerial(**kwargs)
+        start = process_time()
+        # No journal fsyncs in the timing, and keep the emulated part out of
+        # the user's SFDP cache.
+        programmer.flash(port, f.name, journal=False, cache_path=None)
+        cpu = process_time() - start
+
+    print(f"{size // 1024} KiB in {port.frames} frames")
+    print(f"host cpu  {cpu * 1e3:10.1f} ms")
+    print(f"emulated  {port.now * 1e3:10.1f} ms ({size / port.now / 1024:.1f} KiB/s)")
@@ -0,0 +1,297 @@
+""" Continuous, run-length compressed signal capture over USB serial.
+
+`StreamingCapture` watches a list of signals in the sync domain and, every
+time their value changes, pushes a record of the value that just ended and
+how many cycles it lasted through an EBR FIFO to a USB serial stream. Idle
+stretches cost one record per 2**15 cycles, so the capture can run for as
+long as the host keeps reading.
+
+Records are split into 7-bit groups, least significant first, sent one per
+byte with bit 7 set on the first byte only, so the host can find record
+boundaries from any point in the stream. A record is Cat(sample, run,
+overflow): the sample held for run + 1 cycles, with overflow set if changes
+during that time were dropped because the FIFO was full. Runs still add up
+to the exact capture time, as long as the FIFO is never full for more than
+2**31 cycles in a row.
+
+On the host, `stream` reads the port into a ring buffer from a thread and
+writes VCD as records are decoded.
+"""
+
+import json
+import threading
+import time
+from nmigen import *
+from nmigen.lib.fifo import AsyncFIFOBuffered
+
+RUN_BITS = 15
+
+def record_layout(widths, run_bits=RUN_BITS):
+    """ Return (record bits, bytes per record) for signals of these widths. """
+    bits = sum(widths) + run_bits + 1
+    return bits, -(-bits // 7)
+
+class StreamingCapture(Elaboratable):
+    def __init__(self, signals, tx, depth=1024, run_bits=RUN_BITS):
+        self.signals  = signals
+        self.tx       = tx
+        self.depth    = depth
+        self.run_bits = run_bits
+        self.record_bits, self.record_bytes = record_layout([len(s) for s in signals], run_bits)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.fifo = fifo = AsyncFIFOBuffered(width=self.record_bits, depth=self.depth,
+            r_domain="usb", w_domain="sync")
+
+        sample      = Signal(sum(len(s) for s in self.signals))
+        last_sample = Signal.like(sample)
+        run         = Signal(self.run_bits)
+        overflow    = Signal()
+        primed      = Signal()
+        # Full-length runs that wrapped while the FIFO was full, still to be
+        # sent. 16 bits cover 2**31 cycles (about 45s at 48MHz) of the host
+        # not reading before any time is lost.
+        owed        = Signal(16)
+
+        max_run  = (1 << self.run_bits) - 1
+        max_owed = (1 << len(owed)) - 1
+        full_run = run == max_run
+        m.d.comb += [
+            sample.eq(Cat(*self.signals)),
+            fifo.w_data.eq(Cat(last_sample, Mux(owed != 0, max_run, run), overflow)),
+        ]
+
+        # Close the current run when the value changes or the counter is
+        # about to wrap. With the FIFO full the run keeps going and only the
+        # intermediate values are lost; should it wrap, the full run is
+        # counted in owed and sent as soon as the FIFO has room, so no time
+        # goes missing either way.
+        changed = sample != last_sample
+        with m.If(~primed):
+            m.d.sync += [
+                last_sample.eq(sample),
+                primed.eq(1)
+            ]
+        with m.Elif((owed != 0) & fifo.w_rdy):
+            m.d.comb += fifo.w_en.eq(1)
+            m.d.sync += owed.eq(owed - 1)
+            with m.If(full_run):
+                m.d.sync += [
+                    owed.eq(owed),
+                    run.eq(0)
+                ]
+            with m.Else():
+                m.d.sync += run.eq(run + 1)
+            with m.If(changed):
+                m.d.sync += overflow.eq(1)
+        with m.Elif((changed | full_run) & fifo.w_rdy):
+            m.d.comb += fifo.w_en.eq(1)
+            m.d.sync += [
+                last_sample.eq(sample),
+                run.eq(0),
+                overflow.eq(0)
+            ]
+        with m.Else():
+            with m.If(~full_run):
+                m.d.sync += run.eq(run + 1)
+            with m.Elif(owed != max_owed):
+                m.d.sync += [
+                    owed.eq(owed + 1),
+                    run.eq(0)
+                ]
+            # Only with owed saturated does the run stop counting; flag that
+            # like a dropped change.
+            with m.If(changed | full_run & (owed == max_owed)):
+                m.d.sync += overflow.eq(1)
+
+        shreg = Signal(7 * self.record_bytes)
+        byte_ctr = Signal(range(self.record_bytes))
+        with m.FSM(domain="usb"):
+            with m.State("IDLE"):
+                m.d.comb += fifo.r_en.eq(1)
+                with m.If(fifo.r_rdy):
+                    m.d.usb += [
+                        shreg.eq(fifo.r_data),
+                        byte_ctr.eq(0)
+                    ]
+                    m.next = "SEND"
+            with m.State("SEND"):
+                last_byte = byte_ctr == self.record_bytes - 1
+                m.d.comb += [
+                    self.tx.valid.eq(1),
+                    self.tx.payload.eq(Cat(shreg[:7], byte_ctr == 0)),
+                    # Let a short packet go out once there's nothing queued.
+                    self.tx.last.eq(last_byte & ~fifo.r_rdy),
+                ]
+                with m.If(self.tx.ready):
+                    m.d.usb += [
+                        shreg.eq(shreg >> 7),
+                        byte_ctr.eq(byte_ctr + 1)
+                    ]
+                    with m.If(last_byte):
+                        m.next = "IDLE"
+
+        return m
+
+def write_manifest(path, mode, signals, sample_period, **extra):
+    """ Describe a built capture design for `frontend`: signals is a list of
+    (name, width) in capture order.
+    """
+    with open(path, "w") as f:
+        json.dump(dict(mode=mode, signals=signals, sample_period=sample_period, **extra), f, indent=1)
+
+def read_manifest(path):
+    with open(path) as f:
+        return json.load(f)
+
+class RingBuffer:
+    # Fixed-size byte ring between the serial reader thread and the decoder.
+    # If the decoder falls behind, the oldest data is dropped and counted.
+    def __init__(self, size):
+        self.buf     = bytearray(size)
+        self.head    = 0
+        self.tail    = 0
+        self.dropped = 0
+        self.closed  = False
+        self.cond    = threading.Condition()
+
+    def write(self, data):
+        size = len(self.buf)
+        data = memoryview(data)
+        with self.cond:
+            if len(data) > size:
+                self.dropped += len(data) - size
+                data = data[-size:]
+            pos = self.head % size
+            first = min(len(data), size - pos)
+            self.buf[pos:pos + first] = data[:first]
+            self.buf[:len(data) - first] = data[first:]
+            self.head += len(data)
+            if self.head - self.tail > size:
+                self.dropped += self.head - self.tail - size
+                self.tail = self.head - size
+            self.cond.notify()
+
+    def read(self, timeout=None):
+        with self.cond:
+            if self.head == self.tail and not self.closed:
+                self.cond.wait(timeout)
+            size = len(self.buf)
+            start, end = self.tail % size, self.head % size
+            if self.head == self.tail:
+                data = b""
+            elif start < end:
+                data = bytes(self.buf[start:end])
+            else:
+                data = bytes(self.buf[start:] + self.buf[:end])
+            self.tail = self.head
+            return data
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+class RecordDecoder:
+    def __init__(self, widths, run_bits=RUN_BITS):
+        self.widths = widths
+        self.run_bits = run_bits
+        self.sample_bits = sum(widths)
+        _, self.record_bytes = record_layout(widths, run_bits)
+        self.partial = []
+        self.resyncs = 0
+
+    def feed(self, data):
+        """ Yield (values, run, overflow) for every complete record in data,
+        values being one int per signal.
+        """
+        partial = self.partial
+        for byte in data:
+            if byte & 0x80:
+                if partial:
+                    self.resyncs += 1
+                partial = [byte & 0x7f]
+            elif partial:
+                partial.append(byte)
+            if len(partial) == self.record_bytes:
+                value = 0
+                for group in reversed(partial):
+                    value = (value << 7) | group
+                partial = []
+                values = []
+                for width in self.widths:
+                    values.append(value & ((1 << width) - 1))
+                    value >>= width
+                run = value & ((1 << self.run_bits) - 1)
+                yield values, run, bool(value >> self.run_bits & 1)
+        self.partial = partial
+
+def stream(port="/dev/ttyACM0", manifest="build/spi_test.json", vcd_path="spi.vcd",
+           seconds=None, ring_size=1 << 24):
+    """ Capture from a streaming build until `seconds` have passed (or
+    Ctrl-C), writing VCD to vcd_path as records arrive.
+    """
+    from serial import Serial
+    from vcd import VCDWriter
+
+    desc = read_manifest(manifest)
+    names = [name for name, _ in desc["signals"]]
+    widths = [width for _, width in desc["signals"]]
+    period_ps = desc["sample_period"] * 1e12
+    decoder = RecordDecoder(widths, desc.get("run_bits", RUN_BITS))
+    ring = RingBuffer(ring_size)
+
+    def reader(ser):
+        while not ring.closed:
+            data = ser.read(max(1, ser.in_waiting))
+            if data:
+                ring.write(data)
+
+    cycles = 0
+    idle = 0
+    records = 0
+    overflows = 0
+    cs = names.index("spi.cs") if "spi.cs" in names else None
+    with Serial(port, timeout=0.1) as ser, open(vcd_path, "w") as f, \
+            VCDWriter(f, timescale="1 ps", date=time.ctime()) as vcd:
+        variables = []
+        for name, width in desc["signals"]:
+            scope, _, var = name.rpartition(".")
+            variables.append(vcd.register_var(scope or "top", var, "wire", size=width))
+        overflow_var = vcd.register_var("capture", "overflow", "wire", size=1)
+
+        thread = threading.Thread(target=reader, args=(ser,), daemon=True)
+        thread.start()
+        began = time.monotonic()
+        try:
+            while seconds is None or time.monotonic() - began < seconds:
+                for values, run, overflow in decoder.feed(ring.read(0.1)):
+                    t = round(cycles * period_ps)
+                    for var, value in zip(variables, values):
+                        vcd.change(var, t, value)
+                    vcd.change(overflow_var, t, int(overflow))
+                    cycles += run + 1
+                    records += 1
+                    overflows += overflow
+                    # Runs add up to the exact time even when changes were
+                    # dropped, so the cs transitions give the idle time; it is
+                    # only approximate for runs that lost a cs change.
+                    if cs is not None and not values[cs]:
+                        idle += run + 1
+        except KeyboardInterrupt:
+            pass
+        finally:
+            ring.close()
+            thread.join()
+
+    captured = cycles * desc["sample_period"]
+    print(f"{records} records, {captured * 1e3:.3f} ms captured to {vcd_path}")
+    print(f"{overflows} runs with dropped changes, {ring.dropped} bytes dropped on the host, "
+          f"{decoder.resyncs} resyncs")
+    if cs is not None and cycles:
+        print(f"bus idle (cs deasserted) {100 * idle / cycles:.1f}% of the time", end="")
+        if overflows:
+            print(", approximate as changes were dropped", end="")
+        print()
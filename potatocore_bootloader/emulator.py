@@ -0,0 +1,300 @@
+""" Host-side model of `Top` for exercising `programmer` without a board.
+
+`EmulatedSerial` stands in for a `serial.Serial` connected to the bootloader.
+It parses the same `.`-framed hex protocol as `SerialIHexInput`, runs each
+command against an in-memory `SpiFlash` and queues the replies `Top` would
+send. Time is virtual: every frame advances a clock by the USB, SPI and flash
+busy times it would cost on hardware, so runs are deterministic and
+`EmulatedSerial.now` gives the time a real board would have taken.
+"""
+
+import time
+
+# Gateware timings: SpiController spends two 48MHz "sync" cycles per bit plus
+# START/DONE, and Top hands each byte over in the 12MHz "usb" domain.
+SPI_BYTE_TIME = 18 / 48e6 + 2 / 12e6
+
+# SFDP contents of a W25Q128JV: header, one parameter header and the 16 DWORD
+# Basic Flash Parameter Table at 0x80.
+W25Q128JV_SFDP = (
+    bytes.fromhex("53464450 050100ff 00050110 800000ff").ljust(0x80, b"\xff") +
+    bytes.fromhex(
+        "e520f9ff ffffff07 44eb086b 083b42bb"
+        "feffffff ffff0000 ffff40eb 0c200f52"
+        "10d80000 3602a600 82ea14c9 e9637633"
+        "7a757a75 f7a2d55c 19f74dff e930f880"
+    )
+)
+
+class SpiFlash:
+    """ SPI NOR flash model. Defaults follow a W25Q128JV: 16MiB, 256 byte
+    pages, 4K/32K/64K erase and its SFDP table, with typical (not
+    worst-case) timings.
+    """
+
+    def __init__(self, size=16 << 20, jedec_id=b"\xef\x40\x18", page_size=256,
+                 program_time=0.7e-3, erase_times=None, chip_erase_time=40.0,
+                 sfdp=W25Q128JV_SFDP):
+        self.data = bytearray(b"\xff" * size)
+        self.jedec_id = jedec_id
+        self.sfdp = sfdp
+        self.page_size = page_size
+        self.program_time = program_time
+        self.erase_times = {
+            0x20: (0x1000, 45e-3),
+            0x52: (0x8000, 120e-3),
+            0xd8: (0x10000, 150e-3),
+        } if erase_times is None else erase_times
+        self.chip_erase_time = chip_erase_time
+        self.wel = False
+        self.busy_until = 0.0
+
+    def busy(self, now):
+        return now < self.busy_until
+
+    def _addr(self, cmd, offset=1):
+        return int.from_bytes(cmd[offset:offset + 3], "big") % len(self.data)
+
+    def _read(self, addr, n):
+        size = len(self.data)
+        return bytes(self.data[(addr + i) % size] for i in range(n)) \
+            if addr + n > size else bytes(self.data[addr:addr + n])
+
+    def transfer(self, now, cmd, n):
+        """ Run one chip-select cycle: shift out `cmd`, then `n` dummy bytes,
+        returning the `n` bytes shifted in while they were sent.
+        """
+        if not cmd:
+            return b"\xff" * n
+        op = cmd[0]
+        if op == 0x05:
+            return bytes([int(self.busy(now)) | (int(self.wel) << 1)]) * n
+        if self.busy(now):
+            # Everything but a status read is ignored while WIP is set.
+            return b"\xff" * n
+        if op == 0x9f:
+            return (self.jedec_id + b"\x00" * n)[:n]
+        if op == 0x03:
+            # Returned bytes start on the byte after the address.
+            return self._read(self._addr(cmd) + len(cmd) - 4, n)
+        if op == 0x0b:
+            return self._read(self._addr(cmd) + max(len(cmd) - 5, 0), n)
+        if op == 0x5a:
+            # Unimplemented SFDP space reads back as 0xff; sfdp=b"" models a
+            # part without SFDP.
+            addr = self._addr(cmd) + max(len(cmd) - 5, 0)
+            return (self.sfdp[addr:addr + n] + b"\xff" * n)[:n]
+        if op == 0x06:
+            self.wel = True
+        elif op == 0x04:
+            self.wel = False
+        elif op == 0x02 and self.wel:
+            addr = self._addr(cmd)
+            page = addr - addr % self.page_size
+            for i, b in enumerate(cmd[4:4 + self.page_size]):
+                a = page + (addr + i) % self.page_size
+                self.data[a] &= b
+            self.wel = False
+            self.busy_until = now + self.program_time
+        elif op in self.erase_times and self.wel:
+            size, duration = self.erase_times[op]
+            addr = self._addr(cmd)
+            addr -= addr % size
+            self.data[addr:addr + size] = b"\xff" * size
+            self.wel = False
+            self.busy_until = now + duration
+        elif op in (0x60, 0xc7) and self.wel:
+            self.data[:] = b"\xff" * len(self.data)
+            self.wel = False
+            self.busy_until = now + self.chip_erase_time
+        return b"\xff" * n
+
+class EmulatedSerial:
+    """ Drop-in replacement for the `serial.Serial` the programmer talks to.
+
+    `latency` is the one-way USB latency per transfer and `rate` the usable
+    link throughput in bytes per second. With `realtime` set, reads sleep
+    for the emulated time instead of only accounting for it.
+    """
+
+    def __init__(self, flash=None, latency=0.5e-3, rate=1e6, timeout=2,
+                 realtime=False):
+        self.flash    = SpiFlash() if flash is None else flash
+        self.latency  = latency
+        self.rate     = rate
+        self.timeout  = timeout
+        self.realtime = realtime
+        self.now      = 0.0
+        self.frames   = 0
+        self.errors   = 0
+        # Device side state, as held by Top and SerialIHexOutput.
+        self._device_time = 0.0
+        self._tx_free = 0.0
+        self._leader = b"\x00"
+        self._frame  = None
+        self._digit  = None
+        self._replies = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def flush(self):
+        pass
+
+    @property
+    def in_waiting(self):
+        return sum(len(data) for ready, data in self._replies if ready <= self.now)
+
+    def reset_input_buffer(self):
+        self._replies.clear()
+
+    def write(self, data):
+        data = bytes(data)
+        arrival = self.now + self.latency + len(data) / self.rate
+        for c in data:
+            self._rx_char(c, arrival)
+        return len(data)
+
+    def read(self, size=1):
+        out = bytearray()
+        while len(out) < size and self._replies:
+            ready, data = self._replies[0]
+            if self.timeout is not None and ready > self.now + self.timeout:
+                break
+            take = data[:size - len(out)]
+            out += take
+            self._advance(ready)
+            if len(take) < len(data):
+                self._replies[0] = (ready, data[len(take):])
+            else:
+                self._replies.pop(0)
+        if len(out) < size and self.timeout is not None:
+            self._advance(self.now + self.timeout)
+        return bytes(out)
+
+    def readline(self):
+        out = bytearray()
+        while not out.endswith(b"\n"):
+            c = self.read(1)
+            if not c:
+                break
+            out += c
+        return bytes(out)
+
+    def _advance(self, t):
+        if t > self.now:
+            if self.realtime:
+                time.sleep(t - self.now)
+            self.now = t
+
+    def _reply(self, t, line):
+        # Replies share the link one after another and reach the host one
+        # USB latency after they are sent.
+        self._tx_free = max(t, self._tx_free) + len(line) / self.rate
+        self._replies.append((self._tx_free + self.latency, line))
+
+    def _rx_char(self, c, arrival):
+        # Mirror SerialIHexInput: wait for ".", then read hex digit pairs
+        # into count, return, data and checksum bytes.
+        if self._frame is None:
+            if c == 0x2e:
+                self._frame = bytearray()
+                self._digit = None
+            return
+        try:
+            nibble = int(chr(c), 16)
+        except ValueError:
+            self._frame = None
+            self._error(arrival)
+            return
+        if self._digit is None:
+            self._digit = nibble
+            return
+        self._frame.append((self._digit << 4) | nibble)
+        self._digit = None
+        frame = self._frame
+        if len(frame) >= 2 and len(frame) == frame[0] + 3:
+            self._frame = None
+            self._run(frame, arrival)
+
+    def _start(self, arrival):
+        # Top waits for WIP to clear before it accepts the next frame.
+        start = max(self._device_time, arrival)
+        if self.flash.busy(start):
+            start = self.flash.busy_until
+        return start
+
+    def _error(self, arrival):
+        t = self._start(arrival)
+        self.errors += 1
+        self._leader = b"e"
+        self._device_time = t
+        self._reply(t, b"e\n")
+
+    def _run(self, frame, arrival):
+        t = self._start(arrival)
+        self.frames += 1
+        checksum = sum(frame) & 0xff
+        if checksum:
+            self.errors += 1
+            self._leader = b"c"
+            self._device_time = t
+            self._reply(t, b"c" + f"{checksum:02X}".encode("ascii") + b"\n")
+            return
+        count, ret, cmd = frame[0], frame[1], bytes(frame[2:-1])
+        t += (count + ret) * SPI_BYTE_TIME
+        data = self.flash.transfer(t, cmd, ret)
+        self._device_time = t
+        if ret == 0:
+            self._leader = b"."
+            self._reply(t, b".\n")
+        else:
+            # SPI_READ reuses whatever start character was sent last.
+            self._reply(t, self._leader + data.hex().upper().encode("ascii") + b"\n")
+
+class _StreamReader:
+    def __init__(self, port):
+        self.port = port
+
+    async def readline(self):
+        # Emulated time passes as an asyncio sleep when running in realtime,
+        # so several emulated boards can share one event loop.
+        import asyncio
+        port = self.port
+        before = port.now
+        realtime, port.realtime = port.realtime, False
+        try:
+            line = port.readline()
+        finally:
+            port.realtime = realtime
+        await asyncio.sleep(port.now - before if realtime else 0)
+        return line
+
+class _StreamWriter:
+    def __init__(self, port):
+        self.port = port
+
+    def write(self, data):
+        self.port.write(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.port.close()
+
+def open_connection(port=None, **kwargs):
+    """ Return an (EmulatedSerial, reader, writer) triple, the latter two
+    usable as the streams of an aio.AsyncProgrammer.
+    """
+    # The reader gets whatever has been sent without waiting on the port;
+    # timeouts are up to AsyncProgrammer.
+    kwargs.setdefault("timeout", None)
+    port = EmulatedSerial(**kwargs) if port is None else port
+    return port, _StreamReader(port), _StreamWriter(port)
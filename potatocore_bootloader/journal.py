@@ -0,0 +1,70 @@
+""" On-disk progress journal for `programmer.flash`.
+
+The journal is a small JSON file naming the image (by SHA-256), where it is
+being written, and how far it has been programmed and verified. It is
+rewritten atomically after every sector, so whatever interrupts a run, the
+file on disk describes a prefix of the image that is known good.
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+def image_digest(image):
+    return hashlib.sha256(image).hexdigest()
+
+def journal_path(image_path, device=None):
+    # One journal per image and board, so that boards flashed side by side
+    # neither resume from nor clear each other's progress.
+    if device is None:
+        return f"{image_path}.journal"
+    device = re.sub(r"[^\w.-]", "_", os.path.basename(device))
+    return f"{image_path}.{device}.journal"
+
+class Journal:
+    def __init__(self, path, digest, base_addr, size):
+        self.path      = path
+        self.digest    = digest
+        self.base_addr = base_addr
+        self.size      = size
+
+    def load(self):
+        """ Return the image offset up to which a previous run verified this
+        same image at this same address, or 0 if there is nothing to resume.
+        """
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if (state.get("sha256"), state.get("base_addr"), state.get("size")) != \
+                (self.digest, self.base_addr, self.size):
+            return 0
+        verified = state.get("verified", 0)
+        return verified if isinstance(verified, int) and 0 <= verified <= self.size else 0
+
+    def record(self, verified):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".",
+                                   prefix=os.path.basename(self.path) + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({
+                    "sha256":    self.digest,
+                    "base_addr": self.base_addr,
+                    "size":      self.size,
+                    "verified":  verified,
+                }, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -1,45 +1,472 @@
-from serial import Serial
-from itertools import islice, count
-
-def byte_add(a, b):
-    return (a + b) & 0xff
-
-def complement(a):
-    return (0x100 - (a & 0xff)) & 0xff
-
-def command(out_bytes, command):
-    command_bytes = bytes(command)
-    in_bytes = len(command)
-    return f".{in_bytes:02x}{out_bytes:02x}{command.hex()}{complement(in_bytes + out_bytes + sum(command_bytes)):02x}\r\n".encode("utf8")
-
-def run_command(port, out_bytes, cmd_buf):
-    port.write(command(out_bytes, cmd_buf))
-    port.flush()
-    return port.readline()
-
-def chunk_iterable(iterable, size):
-    it = iter(iterable)
-    while True:
-        chunk = bytes(islice(it, size))
-        if not chunk:
-            break
-        yield chunk
-
-def chunk_file(f, chunk_size):
-    for chunk in iter(lambda: f.read(chunk_size), b""):
-        yield chunk
-
-def flash(port="/dev/ttyACM0", path="build/top.bit", base_addr=0x200_000):
-    with Serial(port) as port:
+from binascii import hexlify, unhexlify, Error as HexError
+from contextlib import nullcontext
+from zlib import adler32
+import mmap
+import os
+import time
+import traceback
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple
+from .journal import Journal, image_digest, journal_path
+from .sfdp import ADDRESS_LIMIT, FlashInfo, CACHE_PATH, probe
+
+# The gateware frame counters are 8 bits wide, so a frame carries at most
+# 255 bytes in each direction.
+MAX_COMMAND = 0xff
+MAX_RETURN  = 0xff
+
+# ".", count, return, command, checksum, "\r\n"
+FRAME_SIZE = 1 + 2 + 2 + 2 * MAX_COMMAND + 2 + 2
+
+class ReplyError(Exception):
+    # Raised when the device answers with a checksum ("c") or parse ("e")
+    # error, or with a line that doesn't have the expected shape.
+    def __init__(self, reply):
+        super().__init__(f"Bad reply from device: {bytes(reply)!r}")
+        self.reply = bytes(reply)
+
+class Encoder:
+    # Collects command frames for one write to the port. Each frame is
+    # assembled with a single %-format, hex encoded in one go and appended to
+    # a buffer that is reused from batch to batch. The header (opcode and
+    # address) and payload are passed separately so that image pages can be
+    # handed over without first being joined to their header.
+    def __init__(self, frames=1):
+        self.buf  = bytearray(FRAME_SIZE * frames)
+        self.view = memoryview(self.buf)
+        self.len  = 0
+
+    def clear(self):
+        self.len = 0
+
+    def add(self, out_bytes, header, payload=b""):
+        n = len(header) + len(payload)
+        if n > MAX_COMMAND or out_bytes > MAX_RETURN:
+            raise ValueError(f"Command too long: {n} bytes in, {out_bytes} out")
+        # The low half of an Adler-32 is 1 + sum(data), exact for inputs of
+        # up to 256 bytes, hence summing header and payload separately. The
+        # high half is a multiple of 256 and drops out of the checksum.
+        checksum = (2 - n - out_bytes - adler32(header) - adler32(payload)) & 0xff
+        frame = b".%s\r\n" % hexlify(b"%c%c%b%b%c" % (n, out_bytes, header, payload, checksum))
+        pos = self.len
+        end = pos + len(frame)
+        if end > len(self.buf):
+            raise ValueError("Encoder buffer is full")
+        self.buf[pos:end] = frame
+        self.len = end
+        return self.view[pos:end]
+
+    def frames(self):
+        return self.view[:self.len]
+
+    def encode(self, out_bytes, header, payload=b""):
+        self.len = 0
+        return self.add(out_bytes, header, payload)
+
+def decode_reply(line, size, out):
+    # Decode a single reply line carrying size bytes into out.
+    if len(line) != 2 * size + 2 or line[:1] != b"." or line[-1:] != b"\n":
+        raise ReplyError(line)
+    try:
+        out[:size] = unhexlify(line[1:-1])
+    except HexError:
+        raise ReplyError(line)
+    return out[:size]
+
+class Decoder:
+    # Decodes replies in bulk. Successful replies have a fixed length, so a
+    # whole batch is read with a single port.read() and unhexlified straight
+    # into the caller's buffer. A reply of the wrong shape (a "c" or "e" error
+    # somewhere in the batch) is completed with readline() and raised.
+    def __init__(self, size=MAX_RETURN):
+        self.buf  = bytearray(size)
+        self.view = memoryview(self.buf)
+
+    def read(self, port, sizes, out=None):
+        # Read one reply per entry of sizes; return the decoded payloads
+        # concatenated into out (or the decoder's own buffer).
+        out = self.view if out is None else out
+        raw = port.read(2 * (sum(sizes) + len(sizes)))
+        pos = 0
+        dst = 0
+        for size in sizes:
+            if not size:
+                # Nothing to decode in the ".\n" of a command without return
+                # bytes, such as the write enable and program of a page write.
+                if raw[pos:pos + 2] != b".\n":
+                    return self._recover(port, raw[pos:])
+                pos += 2
+                continue
+            end = pos + 2 * size + 2
+            if raw[pos:pos + 1] != b"." or raw[end - 1:end] != b"\n":
+                return self._recover(port, raw[pos:])
+            try:
+                out[dst:dst + size] = unhexlify(raw[pos + 1:end - 1])
+            except HexError:
+                raise ReplyError(raw[pos:end])
+            pos = end
+            dst += size
+        return out[:dst]
+
+    def _recover(self, port, raw):
+        # Out of step with the expected replies: report the first line that
+        # doesn't decode as a reply of the expected size.
+        line, _, _ = raw.partition(b"\n")
+        if len(line) < len(raw):
+            line += b"\n"
+        else:
+            line += port.readline()
+        raise ReplyError(line)
+
+def map_image(f):
+    # Map the image read-only; mmap refuses empty files, so fall back to an
+    # empty view for those.
+    try:
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except ValueError:
+        return memoryview(b"")
+
+def open_port(port, timeout=2):
+    # Accept either a device path or an already open port-like object, such
+    # as an emulator.EmulatedSerial, which is left open on exit.
+    if isinstance(port, str):
+        from serial import Serial
+        return Serial(port, timeout=timeout)
+    return nullcontext(port)
+
+# Steps of the programmer protocol. The generator methods of `Protocol` yield
+# these and are sent back the result of each; `Link` carries them out on a
+# blocking port and aio.AsyncProgrammer on asyncio streams.
+
+@dataclass
+class Send:
+    # Write frames to the port; count is the number of replies they owe.
+    frames: memoryview
+    count: int
+
+@dataclass
+class Receive:
+    # Read one reply per entry of sizes, decoding the payloads into out.
+    sizes: Tuple[int, ...]
+    out: memoryview
+
+@dataclass
+class Call:
+    # Blocking work on the host, such as hashing the image or syncing the
+    # journal, which the asyncio front end runs in an executor.
+    fn: Callable
+    args: tuple = ()
+
+@dataclass
+class Timeout:
+    # Wait at least this many seconds for each reply from here on: a reply
+    # queued behind an erase only arrives once the erase is done.
+    seconds: float
+
+@dataclass
+class Event:
+    # Progress report, answered with None. phase is one of "probe",
+    # "resume", "restart", "erase", "program", "mismatch", "done" or
+    # "failed"; sector is the address of the erase block being worked on and
+    # done how far into the image the run has got.
+    phase: str
+    sector: int
+    done: int
+    message: Optional[str] = None
+
+# Granularity of the read-back check when resuming from a journal.
+SECTOR_SIZE = 0x1000
+
+class Protocol:
+    # The programmer itself, without any I/O: every method is a generator of
+    # the steps above, so both front ends probe, resume, erase and verify in
+    # exactly the same way. Batched operations keep up to `depth` frames in
+    # each write.
+    def __init__(self, depth=16, info=None):
+        self.depth = depth
+        self.enc   = Encoder(depth)
+        self.buf   = memoryview(bytearray(MAX_RETURN))
+        self.info  = FlashInfo("") if info is None else info
+
+    @property
+    def write_size(self):
+        # Page program opcode and address take 4 of the frame's bytes.
+        return self.info.write_size(MAX_COMMAND - 4)
+
+    def run(self, out_bytes, header, payload=b""):
+        yield Send(self.enc.encode(out_bytes, header, payload), 1)
+        return (yield Receive((out_bytes,), self.buf))
+
+    def commands(self, steps):
+        # Run a generator of (return bytes, command) pairs, as sfdp's are.
+        reply = None
+        try:
+            while True:
+                out_bytes, header = steps.send(reply)
+                reply = bytes((yield from self.run(out_bytes, header)))
+        except StopIteration as stop:
+            return stop.value
+
+    def probe(self, cache_path=CACHE_PATH):
+        self.info = yield from self.commands(probe(cache_path))
+        return self.info
+
+    def read(self, addr, out, chunk=MAX_RETURN, progress=None):
+        # Fill out with flash contents starting at addr. The next batch of
+        # reads is sent before the replies to the previous one are decoded,
+        # so the device always has work queued. progress, if given, is
+        # called with the number of bytes read so far after each batch.
+        out = memoryview(out)
+        pos = 0
+        pending = None
+        while pos < len(out) or pending:
+            batch = None
+            if pos < len(out):
+                self.enc.clear()
+                sizes = []
+                start = pos
+                while pos < len(out) and len(sizes) < self.depth:
+                    n = min(chunk, len(out) - pos)
+                    self.enc.add(n, self.info.read_header(addr + pos))
+                    sizes.append(n)
+                    pos += n
+                yield Send(self.enc.frames(), len(sizes))
+                batch = (start, pos, tuple(sizes))
+            if pending:
+                start, end, sizes = pending
+                yield Receive(sizes, out[start:end])
+                if progress:
+                    progress(end)
+            pending = batch
+        return out
+
+    def write_page(self, addr, page):
+        # Write enable, program and read back go out in one write: Top waits
+        # for WIP before taking each frame, so nothing has to wait on the
+        # host in between. Returns the page as read back.
+        self.enc.clear()
+        self.enc.add(0, b"\x06")
+        self.enc.add(0, b"\x02" + addr.to_bytes(3, "big"), page)
+        self.enc.add(len(page), self.info.read_header(addr))
+        yield Send(self.enc.frames(), 3)
+        return (yield Receive((0, 0, len(page)), self.buf))
+
+    def write_sector(self, addr, sector, erase_op=0x20, base_addr=0):
+        # Erase, program and verify one erase block; return whether it
+        # verified. Events count bytes done from base_addr.
+        good = True
+        size = self.write_size
+        offset = addr - base_addr
+        yield from self.run(0, b"\x06")
+        yield from self.run(0, bytes((erase_op,)) + addr.to_bytes(3, "big"))
+        yield Event("erase", addr, offset)
+        for page_offset in range(0, len(sector), size):
+            page_addr = addr + page_offset
+            page = sector[page_offset:page_offset + size]
+            readback = yield from self.write_page(page_addr, page)
+            # As bytes the comparison is a memcmp; memoryviews compare per item.
+            if bytes(readback) != bytes(page):
+                good = False
+                yield Event("mismatch", addr, offset + page_offset,
+                    f"Error: (0x{page_addr:x} - {page_addr + size - 1:x}):\r\n{readback.hex()}\r\n{page.hex()}")
+            yield Event("program", addr, offset + page_offset + len(page))
+        return good
+
+    def resume_offset(self, journal, image):
+        # Where to pick up a previous run of the same image. The last sector
+        # the journal claims is read back first; if it no longer matches, the
+        # flash was changed behind the journal's back and we start over.
+        verified = journal.load()
+        if not verified:
+            return 0
+        boundary = (verified - 1) - (verified - 1) % SECTOR_SIZE
+        expected = image[boundary:verified]
+        readback = yield from self.read(journal.base_addr + boundary, bytearray(len(expected)))
+        if bytes(readback) != bytes(expected):
+            yield Event("restart", journal.base_addr + boundary, 0,
+                f"Journal doesn't match flash at 0x{journal.base_addr + boundary:x}, starting over")
+            return 0
+        return verified
+
+    def flash(self, image, base_addr=0x200_000, journal_path=None, cache_path=CACHE_PATH):
+        # Probe the flash (see sfdp.probe) to pick erase sizes, write size
+        # and read opcode, then erase, program and verify image at base_addr.
+        # With journal_path set, progress is kept there so that an
+        # interrupted run of the same image resumes after its last good erase
+        # block. Returns whether everything verified.
+        total = len(image)
+        info = yield from self.probe(cache_path)
+        yield Event("probe", base_addr, 0)
+        size = info.usable_size
+        if size is None:
+            size = ADDRESS_LIMIT
+        if base_addr + total > size:
+            raise ValueError(f"Image doesn't fit in {size // 1024} KiB of addressable flash at 0x{base_addr:x}")
+        log = None
+        start = 0
+        if journal_path:
+            digest = yield Call(image_digest, (image,))
+            log = Journal(journal_path, digest, base_addr, total)
+            start = yield from self.resume_offset(log, image)
+            yield Event("resume", base_addr + start, start,
+                        f"Resuming at 0x{base_addr + start:x}" if start else None)
+        plan = list(info.erase_plan(base_addr + start, total - start))
+        slowest = max((info.max_erase_time(opcode) or 0 for _, _, opcode in plan), default=0)
+        if slowest:
+            yield Timeout(slowest + 1)
+        good = True
+        for addr, size, opcode in plan:
+            offset = addr - base_addr
+            block = image[offset:offset + size]
+            good &= yield from self.write_sector(addr, block, opcode, base_addr)
+            if good and log:
+                yield Call(log.record, (offset + len(block),))
+        if good and log:
+            yield Call(log.clear)
+        yield Event("done" if good else "failed", base_addr + total, total)
+        return good
+
+class Link:
+    # Blocking front end: carries out Protocol steps on a port, handing
+    # events to on_event. Also has blocking versions of the common steps.
+    def __init__(self, port, depth=16, info=None, on_event=None):
+        self.port     = port
+        self.proto    = Protocol(depth, info)
+        self.dec      = Decoder()
+        self.on_event = on_event
+
+    @property
+    def info(self):
+        return self.proto.info
+
+    def drive(self, steps):
+        # Run steps to completion and return their result.
+        reply = None
+        try:
+            while True:
+                step = steps.send(reply)
+                reply = None
+                if type(step) is Send:
+                    self.port.write(step.frames)
+                elif type(step) is Receive:
+                    if len(step.sizes) == 1:
+                        # A lone reply is cheapest to take with readline();
+                        # Decoder only pays off for several replies at once.
+                        reply = decode_reply(self.port.readline(), step.sizes[0], step.out)
+                    else:
+                        reply = self.dec.read(self.port, step.sizes, step.out)
+                elif type(step) is Call:
+                    reply = step.fn(*step.args)
+                elif type(step) is Timeout:
+                    if self.port.timeout is not None:
+                        self.port.timeout = max(self.port.timeout, step.seconds)
+                elif self.on_event:
+                    self.on_event(step)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            # On an error, let go of the generator and whatever of the
+            # caller's buffers it holds.
+            steps.close()
+
+    def sync(self):
+        # Drop stale input and send a write disable. Replies to reads start
+        # with whichever start character the device sent last, which is NUL
+        # after power-on and "c"/"e" after an error; an empty reply resets it
+        # to ".".
+        if hasattr(self.port, "reset_input_buffer"):
+            self.port.reset_input_buffer()
+        self.run(0, b"\x04")
+
+    def run(self, out_bytes, header, payload=b""):
+        return self.drive(self.proto.run(out_bytes, header, payload))
+
+    def probe(self, cache_path=CACHE_PATH):
+        return self.drive(self.proto.probe(cache_path))
+
+    def read(self, addr, out, chunk=MAX_RETURN, progress=None):
+        return self.drive(self.proto.read(addr, out, chunk, progress))
+
+    def write_page(self, addr, page):
+        return self.drive(self.proto.write_page(addr, page))
+
+def _print_message(event):
+    if event.message:
+        print(event.message)
+
+def flash(port="/dev/ttyACM0", path="build/top.bit", base_addr=0x200_000, journal=True,
+          cache_path=CACHE_PATH):
+    # See Protocol.flash; with journal set, progress is kept in
+    # <path>.<port>.journal.
+    device = port if isinstance(port, str) else getattr(port, "name", None)
+    with open_port(port) as port:
         with open(path, "rb") as f:
-            for b_addr, chunk in zip(count(base_addr, 0x1000), chunk_file(f, 0x1000)):
-                run_command(port, 0, b"\x06")
-                run_command(port, 0, b"\x20" + b_addr.to_bytes(3, "big"))
-                for addr, page in zip(count(b_addr, 128), chunk_iterable(chunk, 128)):
-                    a = addr.to_bytes(3, "big")
-                    run_command(port, 0, b"\x06")
-                    run_command(port, 0, b"\x02" + a + page)
-                    readback = run_command(port, len(page), b"\x03" + a)
-                    expected = f".{page.hex()}\n".upper().encode("utf8")
-                    if not expected.startswith(readback.strip()):
-                        print(f"Error: (0x{addr:x} - {addr + 127:x}):\r\n{readback}\r\n{expected}")
\ No newline at end of file
+            image = map_image(f)
+            link = Link(port, on_event=_print_message)
+            link.sync()
+            return link.drive(link.proto.flash(image, base_addr,
+                journal_path(path, device) if journal else None, cache_path))
+
+def dump(port="/dev/ttyACM0", path="dump.bin", start=0, length=None, cache_path=CACHE_PATH):
+    # Read flash[start:start+length] (to the end of flash if length is None)
+    # into path. The output file is memory-mapped and filled in place, so
+    # the image is never held in memory as a whole.
+    with open_port(port) as port:
+        link = Link(port)
+        link.sync()
+        info = link.probe(cache_path)
+        size = info.usable_size
+        if start < 0:
+            raise ValueError(f"Negative start address {start}")
+        if length is None:
+            if size is None:
+                raise ValueError("Flash size unknown (no SFDP), give a length")
+            length = size - start
+        if size is None:
+            size = ADDRESS_LIMIT
+        if start >= size:
+            raise ValueError(f"Start 0x{start:x} is past the end of {size // 1024} KiB of addressable flash")
+        if length <= 0:
+            raise ValueError(f"Nothing to read with a length of {length}")
+        if start + length > size:
+            raise ValueError(f"0x{start:x}+0x{length:x} is past the end of {size // 1024} KiB of addressable flash")
+        f = open(path, "w+b")
+        try:
+            with f:
+                f.truncate(length)
+                with mmap.mmap(f.fileno(), length) as mm:
+                    began = time.monotonic()
+                    last = [began]
+                    def progress(done):
+                        now = time.monotonic()
+                        if now - last[0] >= 1 or done == length:
+                            last[0] = now
+                            rate = done / max(now - began, 1e-9) / 1024
+                            print(f"\r0x{start + done:06x} {100 * done // length:3d}% {rate:7.1f} KiB/s", end="", flush=True)
+                    view = memoryview(mm)
+                    try:
+                        link.read(start, view, progress=progress)
+                    except BaseException as e:
+                        # The traceback's frames still hold slices of view,
+                        # which would keep the mmap from closing.
+                        traceback.clear_frames(e.__traceback__)
+                        raise
+                    finally:
+                        view.release()
+                    print()
+                    mm.flush()
+        except BaseException:
+            # Don't leave a file of the full length with holes in it.
+            os.remove(path)
+            raise
+
+def dump_main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Back up the board's SPI flash to a file.")
+    parser.add_argument("path", help="output file")
+    parser.add_argument("--port", default="/dev/ttyACM0")
+    parser.add_argument("--start", type=lambda x: int(x, 0), default=0)
+    parser.add_argument("--length", type=lambda x: int(x, 0), default=None,
+                        help="bytes to read (default: to the end of flash)")
+    args = parser.parse_args()
+    dump(args.port, args.path, args.start, args.length)
@@ -1,16 +1,56 @@
 from nmigen import *
+from nmigen.lib.cdc import FFSynchronizer
 import colorsys
 
+# Values of RgbController.status.
+STATUS_IDLE     = 0
+STATUS_BUSY     = 1
+STATUS_FLASHING = 2
+STATUS_ERROR    = 3
+
+def _rgb(h, s, v):
+    return tuple(min(int(c * 256), 255) for c in colorsys.hsv_to_rgb(h, s, v))
+
+def hue_palette(depth=256, value=.05):
+    # The original rainbow: one full turn of the hue wheel.
+    return [_rgb(i / depth, 1, value) for i in range(depth)]
+
+def status_palette(depth=256, value=.05):
+    # Four banks, one per status, each an animation the LEDs step through.
+    bank = depth // 4
+    def pulse(hue):
+        # Triangle wave in brightness.
+        return [_rgb(hue, 1, value * (1 - abs(2 * i / bank - 1))) for i in range(bank)]
+    return (
+        hue_palette(bank, value) +                                          # idle: rainbow
+        pulse(2 / 3) +                                                      # busy: blue
+        pulse(1 / 12) +                                                     # flashing: amber
+        [_rgb(0, 1, value) if i < bank // 2 else (0, 0, 0) for i in range(bank)] # error: red blink
+    )
+
 class RgbController(Elaboratable):
-    def __init__(self, leds):
+    """ Cycles the LEDs through a palette held in a single Memory (one EBR).
+    The palette is read once per LED at the end of each PWM period, so all
+    LEDs share one read port instead of each indexing its own Arrays.
+
+    `palette` is a list of (r, g, b) tuples whose length is a power of two
+    no larger than 256. With `with_status`, the palette is split into four
+    banks and the 2-bit `status` input picks the bank. It is synchronized
+    into the sync domain, so it may come from any domain, but must be driven
+    straight from a register there.
+    """
+    def __init__(self, leds, palette=None, with_status=False):
         self.leds = leds
-        color_array = [
-            tuple(map(lambda c: int(c * 256), colorsys.hsv_to_rgb(i/256, 1, .05)))
-            for i in range(256)
-        ]
-        self.r_array = Array([c[0] for c in color_array])
-        self.g_array = Array([c[1] for c in color_array])
-        self.b_array = Array([c[2] for c in color_array])
+        self.with_status = with_status
+        if palette is None:
+            palette = status_palette() if with_status else hue_palette()
+        depth = len(palette)
+        assert depth & (depth - 1) == 0 and depth <= 256 and len(leds) + 2 <= 256
+        self.palette = Memory(width=24, depth=depth,
+            init=[r | (g << 8) | (b << 16) for r, g, b in palette])
+        if with_status:
+            assert depth >= 8
+            self.status = Signal(2)
 
     def elaborate(self, platform):
         m = Module()
@@ -18,40 +58,70 @@ class RgbController(Elaboratable):
         clk_freq = platform.default_clk_frequency if platform else 1e4
         timer = Signal(range(int(clk_freq//128)), reset=int(clk_freq//128) - 1)
 
+        depth = self.palette.depth
+        # Entries each LED steps through; a quarter of them per status bank.
+        steps = depth // 4 if self.with_status else depth
+
         pwm_ctr = Signal(8)
-        array_ctr = Signal(8)
+        array_ctr = Signal(range(steps))
+
+        m.submodules.palette = rd = self.palette.read_port(transparent=False)
 
         m.d.sync += pwm_ctr.eq(pwm_ctr - 1)
 
+        if self.with_status:
+            bank = Signal(2)
+            status = Signal(2)
+            m.submodules.status_sync = FFSynchronizer(self.status, status)
+
         with m.If(timer == 0):
             m.d.sync += [
                 timer.eq(timer.reset),
                 array_ctr.eq(array_ctr + 1)
             ]
+            if self.with_status:
+                # Only change bank between steps, so a status that flips
+                # every few cycles doesn't alias into the PWM.
+                m.d.sync += bank.eq(status)
         with m.Else():
             m.d.sync += timer.eq(timer - 1)
 
-        idx_offset = 256 // len(self.leds)
+        idx_offset = steps // len(self.leds)
+        step = Signal.like(array_ctr)
+        if self.with_status:
+            m.d.comb += rd.addr.eq(Cat(step, bank))
+        else:
+            m.d.comb += rd.addr.eq(step)
+
         for idx, led in enumerate(self.leds):
-            offset = idx_offset * idx
             r_latch = Signal(8)
             g_latch = Signal(8)
             b_latch = Signal(8)
-
-            array_idx = Signal(8, reset=offset)
+            r_next  = Signal(8)
+            g_next  = Signal(8)
+            b_next  = Signal(8)
 
             m.d.comb += [
-                array_idx.eq(offset + array_ctr),
                 led.r.eq(r_latch > pwm_ctr),
                 led.g.eq(g_latch > pwm_ctr),
                 led.b.eq(b_latch > pwm_ctr)
             ]
 
+            # LED idx's entry is addressed at pwm_ctr == idx + 2 and read
+            # back a cycle later; all LEDs switch over together at 0.
+            with m.If(pwm_ctr == idx + 2):
+                m.d.comb += step.eq(array_ctr + idx_offset * idx)
+            with m.If(pwm_ctr == idx + 1):
+                m.d.sync += [
+                    r_next.eq(rd.data[0:8]),
+                    g_next.eq(rd.data[8:16]),
+                    b_next.eq(rd.data[16:24])
+                ]
             with m.If(pwm_ctr == 0):
                 m.d.sync += [
-                    r_latch.eq(self.r_array[array_idx]),
-                    g_latch.eq(self.g_array[array_idx]),
-                    b_latch.eq(self.b_array[array_idx])
+                    r_latch.eq(r_next),
+                    g_latch.eq(g_next),
+                    b_latch.eq(b_next)
                 ]
 
         return m
@@ -63,4 +133,4 @@ if __name__ == "__main__":
     sim = Simulator(rgb)
     with sim.write_vcd("rgb.vcd"):
         sim.add_clock(1e-4)
-        sim.run_until(256, run_passive=True)
\ No newline at end of file
+        sim.run_until(256, run_passive=True)
@@ -0,0 +1,264 @@
+""" JEDEC ID and SFDP (JESD216) probing of the attached flash.
+
+`probe` reads the JEDEC ID (0x9F) and, for parts not seen before, the Basic
+Flash Parameter Table through Read SFDP (0x5A). The resulting `FlashInfo` is
+cached on disk per JEDEC ID, so reconnecting to a known part costs a single
+command.
+
+The probing functions do no I/O themselves: they are generators that yield
+(return bytes, command) pairs and are sent back each reply, so that
+`programmer.Link` and `aio.AsyncProgrammer` run the same steps.
+"""
+
+import json
+import os
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional, Tuple
+
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "potatocore_bootloader", "sfdp.json")
+
+# A read command is at most 255 bytes back; SFDP tables are read in pieces.
+_SFDP_CHUNK = 0xff
+
+# Every command carries a 3 byte address.
+ADDRESS_LIMIT = 1 << 24
+
+@dataclass
+class FlashInfo:
+    jedec_id: str
+    size: Optional[int] = None
+    page_size: int = 256
+    # (size, opcode, typical time in seconds or None), smallest first.
+    erase: List[Tuple[int, int, Optional[float]]] = field(default_factory=lambda: [(0x1000, 0x20, None)])
+    # Mode name ("1-1-2", ...) -> (opcode, dummy clocks incl. mode clocks).
+    read_modes: Dict[str, Tuple[int, int]] = field(default_factory=dict)
+    program_time: Optional[float] = None
+    sfdp: bool = False
+    # Worst-case erase time as a multiple of the typical times in erase.
+    erase_max_factor: Optional[int] = None
+    # Set for parts that only take 4 byte addresses (BFPT DW1[18:17]).
+    four_byte_only: bool = False
+
+    @property
+    def usable_size(self):
+        # Parts over 16 MiB start up in 3 byte address mode, so only their
+        # first 16 MiB can be reached.
+        return None if self.size is None else min(self.size, ADDRESS_LIMIT)
+
+    @property
+    def read_op(self):
+        # SpiController only drives a single data line, so of everything the
+        # part supports only 1-1-1 reads apply. Fast read is assumed for
+        # every part with SFDP, as JESD216 does.
+        return (0x0b, 8) if self.sfdp else (0x03, 0)
+
+    def read_header(self, addr):
+        # Opcode, address and dummy bytes of a read starting at addr.
+        op, dummy = self.read_op
+        return bytes((op,)) + addr.to_bytes(3, "big") + bytes(dummy // 8)
+
+    def write_size(self, max_payload):
+        # Largest power of two that fits both in a page and in one frame,
+        # so that consecutive writes never straddle a page.
+        size = 1
+        while size * 2 <= min(self.page_size, max_payload):
+            size *= 2
+        return size
+
+    def max_erase_time(self, opcode):
+        # Worst case for one erase with opcode, or None if not known.
+        for size, op, t in self.erase:
+            if op == opcode and t is not None and self.erase_max_factor:
+                return t * self.erase_max_factor
+        return None
+
+    def erase_plan(self, addr, length):
+        """ Yield (addr, size, opcode) erase steps covering [addr, addr+length),
+        using the largest aligned erase that doesn't spill past the end of the
+        range rounded up to the smallest erase size.
+
+        >>> info = FlashInfo("ef4018", erase=[(0x1000, 0x20, 0.045), (0x8000, 0x52, 0.12), (0x10000, 0xd8, 0.15)])
+        >>> [(hex(a), hex(op)) for a, _, op in info.erase_plan(0x200000, 0x20000)]
+        [('0x200000', '0xd8'), ('0x210000', '0xd8')]
+        >>> [hex(op) for _, _, op in info.erase_plan(0x208000, 0x9000)]
+        ['0x52', '0x20']
+        """
+        smallest, _, small_time = self.erase[0]
+        if addr % smallest:
+            raise ValueError(f"0x{addr:x} isn't aligned to the {smallest} byte erase size")
+        # A larger erase is only worth it if it beats the same area in
+        # smallest erases, which it does on every part seen so far.
+        usable = [
+            (size, opcode) for size, opcode, t in self.erase
+            if size == smallest or t is None or small_time is None or t * smallest < small_time * size
+        ]
+        end = addr + length
+        while addr < end:
+            for size, opcode in reversed(usable):
+                if addr % size == 0 and (addr + size <= end or size == smallest):
+                    break
+            yield addr, size, opcode
+            addr += size
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(
+            jedec_id=d["jedec_id"],
+            size=d["size"],
+            page_size=d["page_size"],
+            erase=[tuple(e) for e in d["erase"]],
+            read_modes={k: tuple(v) for k, v in d["read_modes"].items()},
+            program_time=d["program_time"],
+            sfdp=d["sfdp"],
+            erase_max_factor=d.get("erase_max_factor"),
+            four_byte_only=d.get("four_byte_only", False),
+        )
+
+def _dword(table, n):
+    # JESD216 numbers DWORDs from 1.
+    return int.from_bytes(table[4 * (n - 1):4 * n], "little")
+
+def _bits(value, hi, lo):
+    return (value >> lo) & ((1 << (hi - lo + 1)) - 1)
+
+def _erase_time(dw10, count_lo, units_lo):
+    count = _bits(dw10, count_lo + 4, count_lo)
+    units = (1e-3, 16e-3, 128e-3, 1.0)[_bits(dw10, units_lo + 1, units_lo)]
+    return (count + 1) * units
+
+def parse_bfpt(jedec_id, table):
+    """ Build a FlashInfo from the raw Basic Flash Parameter Table. """
+    dwords = len(table) // 4
+    dw1 = _dword(table, 1)
+    dw2 = _dword(table, 2)
+
+    if dw2 & (1 << 31):
+        size = (1 << _bits(dw2, 30, 0)) // 8
+    else:
+        size = (dw2 + 1) // 8
+
+    read_modes = {}
+    def read_mode(name, dw, hi):
+        # Each fast read field is wait states [4:0], mode clocks [7:5] and
+        # the opcode in the next byte, in the low or high half of dw.
+        half = _bits(_dword(table, dw), 31, 16) if hi else _bits(_dword(table, dw), 15, 0)
+        read_modes[name] = (half >> 8, _bits(half, 4, 0) + _bits(half, 7, 5))
+    if dw1 & (1 << 16):
+        read_mode("1-1-2", 4, False)
+    if dw1 & (1 << 20):
+        read_mode("1-2-2", 4, True)
+    if dw1 & (1 << 21):
+        read_mode("1-4-4", 3, False)
+    if dw1 & (1 << 22):
+        read_mode("1-1-4", 3, True)
+
+    erase = []
+    erase_max_factor = None
+    if dwords >= 9:
+        dw10 = _dword(table, 10) if dwords >= 10 else None
+        if dw10 is not None:
+            # Maximum erase time = 2 * (count + 1) * typical.
+            erase_max_factor = 2 * (_bits(dw10, 3, 0) + 1)
+        fields = [_bits(_dword(table, 8), 15, 0), _bits(_dword(table, 8), 31, 16),
+                  _bits(_dword(table, 9), 15, 0), _bits(_dword(table, 9), 31, 16)]
+        time_bits = [(4, 9), (11, 16), (18, 23), (25, 30)]
+        for (count_lo, units_lo), f in zip(time_bits, fields):
+            if f & 0xff:
+                t = _erase_time(dw10, count_lo, units_lo) if dw10 is not None else None
+                erase.append((1 << (f & 0xff), f >> 8, t))
+    if not erase and _bits(dw1, 1, 0) == 0b01:
+        erase.append((0x1000, _bits(dw1, 15, 8), None))
+    erase.sort()
+
+    page_size = 256
+    program_time = None
+    if dwords >= 11:
+        dw11 = _dword(table, 11)
+        page_size = 1 << _bits(dw11, 7, 4)
+        program_time = (_bits(dw11, 12, 8) + 1) * (64e-6 if dw11 & (1 << 13) else 8e-6)
+
+    return FlashInfo(
+        jedec_id=jedec_id,
+        size=size,
+        page_size=page_size,
+        erase=erase or FlashInfo(jedec_id).erase,
+        read_modes=read_modes,
+        program_time=program_time,
+        sfdp=True,
+        erase_max_factor=erase_max_factor,
+        four_byte_only=_bits(dw1, 18, 17) == 0b10,
+    )
+
+def read_sfdp(addr, length):
+    out = bytearray()
+    while len(out) < length:
+        n = min(_SFDP_CHUNK, length - len(out))
+        out += yield n, b"\x5a" + (addr + len(out)).to_bytes(3, "big") + b"\x00"
+    return bytes(out)
+
+def find_bfpt(header, headers):
+    """ Return (address, length) of the Basic Flash Parameter Table given
+    the SFDP header and parameter headers, or None if there is none.
+    """
+    if header[:4] != b"SFDP":
+        return None
+    for i in range(0, len(headers), 8):
+        ph = headers[i:i + 8]
+        if ph[0] == 0x00 and ph[7] == 0xff:
+            return int.from_bytes(ph[4:7], "little"), 4 * ph[3]
+    return None
+
+def read_info(jedec_id):
+    """ Read and parse the SFDP tables, falling back to the defaults the
+    programmer has always used when the part has none.
+    """
+    header = yield from read_sfdp(0, 8)
+    if header[:4] != b"SFDP":
+        return FlashInfo(jedec_id)
+    bfpt = find_bfpt(header, (yield from read_sfdp(8, 8 * (header[6] + 1))))
+    if bfpt is None:
+        return FlashInfo(jedec_id)
+    return parse_bfpt(jedec_id, (yield from read_sfdp(*bfpt)))
+
+def check_id(jedec_id):
+    jedec_id = bytes(jedec_id).hex()
+    if jedec_id in ("000000", "ffffff"):
+        raise IOError(f"No flash responding to JEDEC ID (read {jedec_id})")
+    return jedec_id
+
+def cached(jedec_id, cache_path=CACHE_PATH):
+    if not cache_path:
+        return None
+    try:
+        with open(cache_path) as f:
+            return FlashInfo.from_dict(json.load(f)[jedec_id])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def store(info, cache_path=CACHE_PATH):
+    if not cache_path:
+        return
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache[info.jedec_id] = asdict(info)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp = cache_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp, cache_path)
+
+def probe(cache_path=CACHE_PATH):
+    """ Identify the attached flash. Pass cache_path=None to always read
+    SFDP.
+    """
+    jedec_id = check_id((yield 3, b"\x9f"))
+    info = cached(jedec_id, cache_path)
+    if info is None:
+        info = yield from read_info(jedec_id)
+        store(info, cache_path)
+    if info.four_byte_only:
+        raise IOError(f"Flash {jedec_id} only takes 4 byte addresses, which the programmer doesn't send")
+    return info
@@ -58,9 +58,22 @@ class SpiController(Elaboratable):
             return m
 
 class SpiTest(Elaboratable):
+    # Signals available for capture, by name.
+    SIGNALS = ["spi.din", "spi.dout", "spi.clk", "spi.copi", "spi.cipo",
+               "spi.cs", "spi.first", "spi.last", "spi.ready"]
+    # Only chip select changes seldom enough to stream: the byte-level
+    # signals change every few cycles during a transfer, which overflows USB
+    # and loses the cs changes in between.
+    STREAM_SIGNALS = ["spi.cs"]
+
+    def __init__(self, streaming=False, signals=None):
+        self.streaming = streaming
+        self.signal_names = signals or (self.STREAM_SIGNALS if streaming else self.SIGNALS)
+        # Filled in by elaborate(): [(name, width)] in capture order.
+        self.signals = None
+
     def elaborate(self, platform):
         from .clock import UsbDomainGenerator
-        from luna.gateware.usb.devices.ila import USBIntegratedLogicAnalyer
 
         m = Module()
 
@@ -69,28 +82,46 @@ class SpiTest(Elaboratable):
         m.submodules.spi = spi = SpiController(bus)
         m.submodules.mclk = Instance("USRMCLK", i_USRMCLKI=spi.clk, i_USRMCLKTS=Signal()) 
         m.submodules.clock = UsbDomainGenerator()
-        m.submodules.ila = ila = USBIntegratedLogicAnalyer(
-            max_packet_size=64,
-            signals=[
-                spi.din,
-                spi.dout,
-                spi.clk,
-                spi.bus.copi,
-                spi.bus.cipo,
-                spi.bus.cs,
-                spi.first,
-                spi.last,
-                spi.ready
-            ],
-            sample_depth=512
-        )
+
+        available = {
+            "spi.din":   spi.din,
+            "spi.dout":  spi.dout,
+            "spi.clk":   spi.clk,
+            "spi.copi":  spi.bus.copi,
+            "spi.cipo":  spi.bus.cipo,
+            "spi.cs":    spi.bus.cs,
+            "spi.first": spi.first,
+            "spi.last":  spi.last,
+            "spi.ready": spi.ready,
+        }
+        signals = [available[name] for name in self.signal_names]
+        self.signals = [(name, len(sig)) for name, sig in zip(self.signal_names, signals)]
+
+        if self.streaming:
+            from luna.full_devices import USBSerialDevice
+            from .capture import StreamingCapture
+            usb = platform.request("usb")
+            m.submodules.serial = serial = USBSerialDevice(bus=usb, idVendor=1337, idProduct=1337)
+            m.submodules.capture = StreamingCapture(signals, serial.tx)
+            m.d.comb += [
+                serial.connect.eq(1),
+                serial.rx.ready.eq(1),
+            ]
+        else:
+            from luna.gateware.usb.devices.ila import USBIntegratedLogicAnalyer
+            m.submodules.ila = self.ila = ila = USBIntegratedLogicAnalyer(
+                max_packet_size=64,
+                signals=signals,
+                sample_depth=512
+            )
 
         with m.FSM() as fsm:
             m.d.comb += [
                 spi.first.eq(fsm.ongoing("START")),
                 spi.last.eq(fsm.ongoing("DONE")),
-                ila.trigger.eq(fsm.ongoing("START"))
             ]
+            if not self.streaming:
+                m.d.comb += ila.trigger.eq(fsm.ongoing("START"))
             unlock = Signal()
             with m.State("START"):
                 m.d.sync += [
@@ -132,34 +163,54 @@ class SpiTest(Elaboratable):
 
         return m
 
-def build():
+MANIFEST = "build/spi_test.json"
+
+def build(streaming=False):
     from .board import DCNextPlatform
+    from .capture import write_manifest
     import os
     os.environ["NEXTPNR_ECP5"] = "yowasp-nextpnr-ecp5"
     os.environ["ECPPACK"] = "yowasp-ecppack"
     platform = DCNextPlatform()
     platform.default_usb_connection = "usb"
-    platform.build(SpiTest(), 
+    design = SpiTest(streaming=streaming)
+    platform.build(design, 
         ecppack_opts=["--freq", "38.8"])
+    # The sync domain runs straight off the board clock.
+    sample_period = 1 / platform.default_clk_frequency
+    if streaming:
+        write_manifest(MANIFEST, "stream", design.signals, sample_period)
+    else:
+        write_manifest(MANIFEST, "ila", design.signals, sample_period,
+            bytes_per_sample=design.ila.bytes_per_sample,
+            sample_depth=design.ila.sample_depth)
+
+def build_stream():
+    build(streaming=True)
 
 def frontend():
+    import argparse
+    from .capture import read_manifest, stream
+    parser = argparse.ArgumentParser(description="Capture from a spi_test build.")
+    parser.add_argument("--manifest", default=MANIFEST)
+    parser.add_argument("--port", default="/dev/ttyACM0", help="serial port (streaming builds)")
+    parser.add_argument("--vcd", default="spi.vcd", help="VCD output (streaming builds)")
+    parser.add_argument("--seconds", type=float, default=None,
+                        help="stop after this long (default: Ctrl-C)")
+    args = parser.parse_args()
+
+    desc = read_manifest(args.manifest)
+    if desc["mode"] == "stream":
+        stream(args.port, args.manifest, args.vcd, args.seconds)
+        return
+
     from luna.gateware.usb.devices.ila import USBIntegratedLogicAnalyzerFrontend
     from types import SimpleNamespace
-    # Dirty hack so that we don't have to figure out how to access the ILA
+    # The frontend only needs the ILA's parameters, which the build recorded.
     ila = SimpleNamespace()
-    ila.bytes_per_sample = 4
-    ila.sample_depth = 512
-    ila.signals = [
-        Signal(8, name="spi.din"),
-        Signal(8, name="spi.dout"),
-        Signal(1, name="spi.clk"),
-        Signal(1, name="spi.copi"),
-        Signal(1, name="spi.cipo"),
-        Signal(1, name="spi.cs"),
-        Signal(1, name="spi.first"),
-        Signal(1, name="spi.last"),
-        Signal(1, name="spi.ready"),
-    ]
-    ila.sample_period = 1e-4
+    ila.bytes_per_sample = desc["bytes_per_sample"]
+    ila.sample_depth = desc["sample_depth"]
+    ila.signals = [Signal(width, name=name) for name, width in desc["signals"]]
+    ila.sample_period = desc["sample_period"]
     frontend = USBIntegratedLogicAnalyzerFrontend(ila=ila)
-    frontend.interactive_display()
\ No newline at end of file
+    frontend.interactive_display()
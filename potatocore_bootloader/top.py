@@ -3,7 +3,7 @@ from luna.full_devices import USBSerialDevice
 from .serial import SerialIHexInput, SerialIHexOutput
 from .spi import SpiController
 from .clock import UsbDomainGenerator
-from .rgb import RgbController
+from .rgb import RgbController, STATUS_IDLE, STATUS_BUSY, STATUS_FLASHING, STATUS_ERROR
 
 class Top(Elaboratable):
     def elaborate(self, platform):
@@ -11,11 +11,11 @@ class Top(Elaboratable):
 
         bus = platform.request("spi")
         usb = platform.request("usb")
-        rgb = [platform.request("rgb_led", i) for i in range(4)]
+        leds = [platform.request("rgb_led", i) for i in range(4)]
 
         input_buffer = Memory(width=8, depth=255)
 
-        m.submodules.rgb = RgbController(rgb)
+        m.submodules.rgb = rgb = RgbController(leds, with_status=True)
 
         m.submodules.car = UsbDomainGenerator()
 
@@ -35,6 +35,14 @@ class Top(Elaboratable):
         bytes_recv   = Signal(8)
         return_bytes = Signal(8)
         stage_done   = Signal()
+        # Set by a bad frame, cleared by the next good one.
+        error        = Signal()
+        # Reloaded whenever POLL_READY finds WIP set and counted down
+        # otherwise (2**21 usb cycles, about 175ms), so a whole erase and
+        # program burst shows as flashing: of the three frames of a page
+        # write only the read back ever waits on WIP.
+        flash_hold   = Signal(21)
+        status       = Signal(2)
 
         m.d.usb += [
             rx.start.eq(0),
@@ -54,7 +62,10 @@ class Top(Elaboratable):
             in_read.addr.eq(bytes_recv)
         ]
 
-        with m.FSM(domain="usb"):
+        with m.If(flash_hold != 0):
+            m.d.usb += flash_hold.eq(flash_hold - 1)
+
+        with m.FSM(domain="usb") as fsm:
             with m.State("START"):
                 m.d.usb += rx.start.eq(~rx.ready)
                 with m.If(~stage_done):
@@ -88,6 +99,8 @@ class Top(Elaboratable):
                             spi.last.eq(1),
                             stage_done.eq(1),
                         ]
+                    with m.If(spi.din[0] & poll_first):
+                        m.d.usb += flash_hold.eq((1 << len(flash_hold)) - 1)
                 with m.If(stage_done & spi.ready & ~spi.bus.cs):
                     m.d.usb += [
                         stage_done.eq(0),
@@ -149,6 +162,7 @@ class Top(Elaboratable):
             with m.State("RUN"):
                 with m.If(rx.checksum):
                     m.d.usb += [
+                        error.eq(1),
                         tx.first.eq(1),
                         tx.last.eq(1),
                         tx.s_chr.eq(ord("c")),
@@ -164,6 +178,7 @@ class Top(Elaboratable):
                     m.d.usb += [
                         bytes_recv.eq(0),
                         stage_done.eq(0),
+                        error.eq(0),
                     ]
                     m.next = "SPI_WRITE"
             with m.State("SPI_WRITE"):
@@ -226,6 +241,7 @@ class Top(Elaboratable):
                         m.next = "START"
             with m.State("ERR"):
                 m.d.usb += [
+                    error.eq(1),
                     tx.first.eq(1),
                     tx.last.eq(1),
                     tx.empty.eq(1),
@@ -239,6 +255,18 @@ class Top(Elaboratable):
                     m.d.usb += stage_done.eq(0)
                     m.next = "START"
 
+        # Registered here so that only glitch-free values reach the
+        # synchronizer in RgbController's domain.
+        with m.If(error):
+            m.d.usb += status.eq(STATUS_ERROR)
+        with m.Elif(flash_hold != 0):
+            m.d.usb += status.eq(STATUS_FLASHING)
+        with m.Elif(fsm.ongoing("START")):
+            m.d.usb += status.eq(STATUS_IDLE)
+        with m.Else():
+            m.d.usb += status.eq(STATUS_BUSY)
+        m.d.comb += rgb.status.eq(status)
+
         return m
 
 def build():
@@ -0,0 +1,48 @@
+import asyncio
+import os
+
+from potatocore_bootloader.aio import AsyncProgrammer
+from potatocore_bootloader.emulator import open_connection
+
+BASE = 0x200_000
+
+def test_flash_side_by_side(tmp_path):
+    # Boards flashed with the same image keep separate journals.
+    path = tmp_path / "top.bit"
+    data = os.urandom(3 * 0x10000)
+    path.write_bytes(data)
+
+    async def one(name):
+        port, reader, writer = open_connection()
+        prog = AsyncProgrammer(reader, writer, name=name)
+        events = [event async for event in prog.flash(str(path), cache_path=None)]
+        return port, events[-1]
+
+    async def main():
+        return await asyncio.gather(one("/dev/ttyACM0"), one("/dev/ttyACM1"))
+
+    for port, last in asyncio.run(main()):
+        assert last.phase == "done"
+        assert port.flash.data[BASE:BASE + len(data)] == data
+    assert os.listdir(tmp_path) == ["top.bit"]
+
+def test_resume_after_cancel(tmp_path):
+    path = tmp_path / "top.bit"
+    data = os.urandom(3 * 0x10000)
+    path.write_bytes(data)
+    port, reader, writer = open_connection()
+
+    async def run(stop=None):
+        prog = AsyncProgrammer(reader, writer, name="/dev/ttyACM0")
+        events = []
+        async for event in prog.flash(str(path), cache_path=None):
+            events.append(event)
+            if event.done == stop:
+                break
+        return events
+
+    asyncio.run(run(stop=0x18000))
+    events = asyncio.run(run())
+    assert events[1].phase == "resume" and events[1].done == 0x10000
+    assert events[-1].phase == "done"
+    assert port.flash.data[BASE:BASE + len(data)] == data
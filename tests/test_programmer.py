@@ -0,0 +1,137 @@
+import os
+
+import pytest
+
+from potatocore_bootloader import programmer
+from potatocore_bootloader.emulator import EmulatedSerial, SpiFlash
+from potatocore_bootloader.programmer import Encoder, Link, ReplyError
+
+BASE = 0x200_000
+
+class Unplugged(EmulatedSerial):
+    # A board that goes away once it has taken `frames` frames.
+    def __init__(self, frames, **kwargs):
+        super().__init__(**kwargs)
+        self.limit = frames
+
+    def write(self, data):
+        if self.frames >= self.limit:
+            raise OSError("unplugged")
+        return super().write(data)
+
+def reconnect(port):
+    # The same board on a fresh port, later on the same clock.
+    again = EmulatedSerial(port.flash)
+    again.now = port.now
+    return again
+
+@pytest.fixture
+def image(tmp_path):
+    path = tmp_path / "top.bit"
+    data = os.urandom(3 * 0x10000)
+    path.write_bytes(data)
+    return str(path), data
+
+def flash(port, path, **kwargs):
+    return programmer.flash(port, path, cache_path=None, **kwargs)
+
+def test_flash(image):
+    path, data = image
+    port = EmulatedSerial()
+    assert flash(port, path)
+    assert port.flash.data[BASE:BASE + len(data)] == data
+    assert port.errors == 0
+    assert not os.path.exists(path + ".journal")
+
+def test_resume(image, capsys):
+    path, data = image
+    # Part way into the second 64K erase block.
+    port = Unplugged(2500)
+    with pytest.raises(OSError):
+        flash(port, path)
+    assert os.path.exists(path + ".journal")
+
+    resumed = reconnect(port)
+    assert flash(resumed, path)
+    assert "Resuming at 0x210000" in capsys.readouterr().out
+    assert resumed.flash.data[BASE:BASE + len(data)] == data
+    full = EmulatedSerial()
+    flash(full, path, journal=False)
+    assert resumed.frames < full.frames
+    assert not os.path.exists(path + ".journal")
+
+def test_stale_journal(image, capsys):
+    path, data = image
+    port = Unplugged(2500)
+    with pytest.raises(OSError):
+        flash(port, path)
+    # Something else wrote the flash since.
+    port.flash.data[BASE + 0x10000 - 1] ^= 0xff
+
+    again = reconnect(port)
+    assert flash(again, path)
+    out = capsys.readouterr().out
+    assert "starting over" in out
+    assert "Resuming" not in out
+    assert again.flash.data[BASE:BASE + len(data)] == data
+
+def test_slow_erase(image):
+    # A 64K erase well over the 2s default timeout, but within the part's
+    # SFDP worst case.
+    path, data = image
+    slow = SpiFlash(erase_times={0x20: (0x1000, 45e-3), 0x52: (0x8000, 120e-3), 0xd8: (0x10000, 2.2)})
+    port = EmulatedSerial(slow)
+    assert flash(port, path, journal=False)
+    assert slow.data[BASE:BASE + len(data)] == data
+
+def test_image_too_large(tmp_path):
+    path = tmp_path / "top.bit"
+    path.write_bytes(bytes(0x2000))
+    with pytest.raises(ValueError):
+        flash(EmulatedSerial(), str(path), base_addr=0xfff000)
+
+def test_dump(tmp_path):
+    port = EmulatedSerial()
+    data = os.urandom(0x12345)
+    port.flash.data[0x1000:0x1000 + len(data)] = data
+    out = tmp_path / "dump.bin"
+    programmer.dump(port, str(out), 0x1000, len(data), cache_path=None)
+    assert out.read_bytes() == data
+
+def test_dump_past_address_limit(tmp_path):
+    out = tmp_path / "dump.bin"
+    with pytest.raises(ValueError):
+        programmer.dump(EmulatedSerial(), str(out), 0xfff000, 0x2000, cache_path=None)
+    assert not out.exists()
+
+def test_dump_error(tmp_path):
+    # The port's own error comes out, not the mmap's, and no half-filled
+    # file is left behind.
+    class Failing(EmulatedSerial):
+        def read(self, size=1):
+            if self.frames > 100:
+                raise OSError("unplugged")
+            return super().read(size)
+    out = tmp_path / "dump.bin"
+    with pytest.raises(OSError, match="unplugged"):
+        programmer.dump(Failing(), str(out), 0, 1 << 20, cache_path=None)
+    assert not out.exists()
+
+@pytest.mark.parametrize("frame, reply", [
+    (None, b"c"),             # checksum
+    (b".0g\r\n", b"e"),      # not hex
+])
+def test_error_replies(frame, reply):
+    port = EmulatedSerial()
+    link = Link(port)
+    if frame is None:
+        frame = bytearray(Encoder().encode(0, b"\x06"))
+        frame[-4:-2] = b"00"
+    port.write(frame)
+    assert port.readline()[:1] == reply
+    # The error start character sticks to read replies until a command
+    # without any resets it.
+    with pytest.raises(ReplyError):
+        link.run(3, b"\x9f")
+    link.sync()
+    assert bytes(link.run(3, b"\x9f")) == port.flash.jedec_id